@@ -16,7 +16,6 @@ setup(
         "torchaudio",
         "data-science-types>=0.2",
         "einops>=0.6",
-        "einops-exts>=0.0.3",
     ],
     classifiers=[
         "Development Status :: 4 - Beta",